@@ -2,59 +2,165 @@
 TCP chat client for the multi-user chatroom application.
 
 This client:
-- Connects to the chat server over a TCP socket.
+- Connects to the chat server over a TCP socket using a single asyncio event loop.
 - Allows the user to register or log in.
 - Sends chat messages to the server.
 - Receives real-time broadcast messages from the server.
-- Polls the server periodically to retrieve missed messages from history.
-- Deduplicates messages using a global last_message_id.
+- Requests the message history page by page after login to catch up on missed messages.
+- Deduplicates messages using a small LRU of recently seen message IDs kept in ClientState.
 """
 
+import asyncio
 import socket
 import json
 import sys
 import threading
-import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from functools import lru_cache
 
 import os
 
+# Here we are using orjson when it is installed; it encodes straight to UTF-8 bytes
+try:
+    import orjson
+
+    json_dumps = orjson.dumps
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(data) -> bytes:
+        return json.dumps(data).encode()
+
+    json_loads = json.loads
+
 HOST = os.getenv("CHAT_SERVER_HOST", "127.0.0.1")
 PORT = int(os.getenv("CHAT_SERVER_PORT", "5000"))
 
 print(f"[DEBUG] Connecting to server at {HOST}:{PORT}")
 
-last_message_id = 0         
-stop_event = threading.Event()
-current_username = ""
+# Here we are allowing long lines, since each history page arrives as one JSON line
+STREAM_LIMIT = 16 * 1024 * 1024
+
+# Here we are remembering the most recent message IDs so a message is printed only once
+SEEN_CAPACITY = 1024
+
+
+@dataclass
+class ClientState:
+    """
+    Here we are keeping the state of one chat session instead of module globals.
+
+    Every access happens on the event loop thread without awaiting in between,
+    so no lock is needed.
+    """
+    username: str = ""
+    seen: OrderedDict = field(default_factory=OrderedDict)
+
+    def mark_seen(self, mid) -> bool:
+        """
+        Here we are recording a message ID in the LRU of recently seen IDs.
+
+        Unlike comparing against the highest ID so far, this stays correct when a broadcast
+        and the history reply arrive out of order.
+
+        Returns:
+            bool: True the first time an ID is seen, False for duplicates.
+        """
+        if mid in self.seen:
+            return False
+        self.seen[mid] = None
+        if len(self.seen) > SEEN_CAPACITY:
+            self.seen.popitem(last=False)
+        return True
 
 
 # Here we are sending the JSON data to the server
 
-def send_json(conn, data: dict):
+async def send_json(writer: asyncio.StreamWriter, data: dict):
     """
     Here we are sending a JSON object followed by newline (server expects line-delimited JSON).
     """
-    conn.sendall((json.dumps(data) + "\n").encode())
+    writer.write(json_dumps(data) + b"\n")
+    await writer.drain()
+
+
+# Here we are sending the two fixed-shape frames without going through the general encoder
+async def send_poll(writer: asyncio.StreamWriter, last_id: int):
+    """
+    Here we are asking the server for the next page of messages with an ID greater than last_id.
+    """
+    writer.write(b'{"action":"poll","last_id":%d}\n' % last_id)
+    await writer.drain()
+
+
+async def send_chat(writer: asyncio.StreamWriter, content: str):
+    """
+    Here we are sending a chat message; only the content needs JSON escaping.
+    """
+    writer.write(b'{"action":"send_message","content":%b}\n' % json_dumps(content))
+    await writer.drain()
 
 
 
 # Here we are receiving the data from the server. This function is used to receive one line of data from the server.
-def recv_one_line(conn: socket.socket):
+async def recv_one_line(reader: asyncio.StreamReader):
     """
     Here we are receiving one line of data from the server.
+
+    Args:
+        reader (asyncio.StreamReader): The stream returned by `asyncio.open_connection`.
+
+    Returns:
+        dict | None: The decoded frame, or None if the connection closed or the line was not valid JSON.
+    """
+    # Here we are skipping blank lines so they are not mistaken for a reply
+    async for line in reader:
+        if not line.strip():
+            continue
+        try:
+            return json_loads(line)
+        except json.JSONDecodeError:
+            return None
+    return None
+
+
+# Here we are reading the keyboard without blocking the event loop
+async def ainput(prompt: str) -> str:
     """
-    data = conn.recv(4096).decode()
-    if not data:
-        return None
-    return json.loads(data.split("\n")[0])
+    Here we are running input() in a daemon thread and awaiting its result.
+
+    A daemon thread is used instead of the default executor because the executor is joined
+    on shutdown, which would keep Ctrl+C waiting for the user to press Enter.
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def settle(line, exc):
+        if fut.done():
+            return
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(line)
+
+    def read():
+        try:
+            loop.call_soon_threadsafe(settle, input(prompt), None)
+        except (EOFError, KeyboardInterrupt) as exc:
+            loop.call_soon_threadsafe(settle, None, exc)
+
+    threading.Thread(target=read, daemon=True).start()
+    return await fut
 
 
 # Here we are formatting the timestamp for display
+@lru_cache(maxsize=4096)
 def format_ts(ts_str: str) -> str:
     """
     Convert server timestamp string to a compact local time like HH:MM.
     Falls back to the original string if parsing fails.
+    Results are cached because the same timestamp arrives in both broadcasts and history.
     """
     try:
         # Support both '...Z' and '+00:00' or with space separator
@@ -63,105 +169,88 @@ def format_ts(ts_str: str) -> str:
         # Ensure timezone-aware, then convert to local system time
         if dt.tzinfo is None:
             dt = dt.replace(tzinfo=timezone.utc)
-        local_dt = dt.astimezone()  # convert to local timezone
+        local_dt = dt.astimezone()  # convert to local timezone, with the DST rules of that date
         return local_dt.strftime("%H:%M")
     except Exception:
         return ts_str
 
-# Here we are receiving the data from the server. This thread is the ONLY place that calls recv().
-def receiver_loop(conn: socket.socket):
+# Here we are receiving the data from the server. This task is the ONLY place that reads the socket after login.
+async def receiver_loop(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, state: ClientState):
     """
-    Here we are receiving the data from the server. This thread is the ONLY place that calls recv().
+    Here we are receiving the data from the server. This task is the ONLY place that reads the socket after login.
+    Each line is one complete JSON frame, even when it straddles several TCP reads.
     It handles:
       - broadcast messages: response == "new_message"
-      - poll responses:     response == "poll"
+      - poll responses:     response == "poll", asking for the next page while "more" is set
     """
-    global last_message_id
-
     try:
-        while not stop_event.is_set():
-            data = conn.recv(4096).decode()
-
-            # If connection is closed or no data, keep looping (or break)
-            if not data:
+        # Server sends one JSON per line
+        async for line in reader:
+            if not line.strip():
                 continue
 
-            # Server sends one JSON per line
-            for line in data.strip().split("\n"):
-                if not line.strip():
-                    continue
-
-                try:
-                    msg = json.loads(line)
-                except json.JSONDecodeError:
-                    continue
+            try:
+                msg = json_loads(line)
+            except json.JSONDecodeError:
+                continue
 
-                rtype = msg.get("response")
-
-                # Broadcast message from server
-                if rtype == "new_message":
-                    sender = msg.get("from", "???")
-                    content = msg.get("content", "")
-                    ts = format_ts(msg.get("timestamp", ""))
-                    mid = msg.get("id", 0)
-                    # Deduplicate against poll results by checking id progression
-                    if mid > last_message_id:
-                        if sender != current_username:
-                            prefix = f"[{ts}] " if ts else ""
-                            print(f"\n{prefix}[{sender}] {content}")
-                        last_message_id = mid
-                        print("> ", end="", flush=True)
-
-                # Poll response (history)
-                elif rtype == "poll":
-                    messages = msg.get("messages", [])
-                    for m in messages:
-                        sender = m.get("sender", "???")
-                        content = m.get("content", "")
-                        ts = format_ts(m.get("timestamp", ""))
-                        mid = m.get("id", 0)
-                        # Print only unseen messages
-                        if mid > last_message_id:
-                            prefix = f"[{ts}] " if ts else ""
-                            print(f"\n{prefix}[{sender}] {content}")
-                            last_message_id = mid
-                    if messages:
-                        print("> ", end="", flush=True)
-
-                # Other responses ignored (login/register handled before threads)
-    except OSError:
-        # Socket closed, exit thread
+            rtype = msg.get("response")
+
+            # Broadcast message from server
+            if rtype == "new_message":
+                sender = msg.get("from", "???")
+                content = msg.get("content", "")
+                ts = format_ts(msg.get("timestamp", ""))
+                mid = msg.get("id", 0)
+                # Deduplicate against poll results
+                if state.mark_seen(mid):
+                    # Our own messages are already on screen, so there is nothing to redraw
+                    if sender != state.username:
+                        prefix = f"[{ts}] " if ts else ""
+                        sys.stdout.write(f"\n{prefix}[{sender}] {content}\n> ")
+                        sys.stdout.flush()
+
+            # Poll response (history)
+            elif rtype == "poll":
+                # Here we are checking the whole batch before recording any of it, so a broadcast
+                # seen earlier cannot be evicted by this batch and then printed a second time
+                messages = msg.get("messages", [])
+                fresh = [m for m in messages if m.get("id", 0) not in state.seen]
+                lines = []
+                for m in fresh:
+                    state.mark_seen(m.get("id", 0))
+                    sender = m.get("sender", "???")
+                    content = m.get("content", "")
+                    ts = format_ts(m.get("timestamp", ""))
+                    prefix = f"[{ts}] " if ts else ""
+                    lines.append(f"\n{prefix}[{sender}] {content}\n")
+                # Here we are writing the whole batch and the prompt with a single flush
+                if lines:
+                    lines.append("> ")
+                    sys.stdout.write("".join(lines))
+                    sys.stdout.flush()
+
+                # Here we are fetching the rest of the history one bounded page at a time
+                if msg.get("more") and messages:
+                    await send_poll(writer, messages[-1].get("id", 0))
+
+            # Other responses ignored (login/register handled before this task starts)
+    except (OSError, ValueError):
+        # Socket closed or oversized frame, stop receiving
         pass
 
-
-# Here we are polling the server for new messages
-def poll_loop(conn: socket.socket):
-    """
-    Periodically asking the server for any messages with id > last_message_id.
-
-    This function:
-    - Sends `{"action": "poll", "last_id": last_message_id}` every second.
-    - Does NOT call `recv()`. Responses are processed by `receiver_loop`.
-    """
-    global last_message_id
-
-    while not stop_event.is_set():
-        try:
-            send_json(conn, {
-                "action": "poll",
-                "last_id": last_message_id
-            })
-        except OSError:
-            break
-
-        time.sleep(1)
+    print("\nDisconnected from server.")
 
 
 # Here we are handling the login and registration flow
-def auth_flow(conn: socket.socket):
+async def auth_flow(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     """
     Here we are handling the menu for login/register.
-    Here we are running before starting the receiver threads.
+    Here we are running before starting the receiver task.
+
+    Args:
+        reader (asyncio.StreamReader): The stream shared with `receiver_loop`.
+        writer (asyncio.StreamWriter): The stream to send through.
     
     Returns:
         str: The username of the successfully logged-in user.
@@ -169,7 +258,7 @@ def auth_flow(conn: socket.socket):
     while True:
         print("\n1. Login")
         print("2. Register")
-        choice = input("Choose (1/2): ").strip()
+        choice = (await ainput("Choose (1/2): ")).strip()
 
     # Here we are validating the menu choice
         if choice not in ("1", "2"):
@@ -178,22 +267,24 @@ def auth_flow(conn: socket.socket):
 
     # Here we are handling the login flow
         if choice == "1":
-            username = input("Username: ").strip()
-            password = input("Password: ").strip()
+            username = (await ainput("Username: ")).strip()
+            password = (await ainput("Password: ")).strip()
 
-            send_json(conn, {
+            await send_json(writer, {
                 "action": "login",
                 "username": username,
                 "password": password
             })
 
-            resp = recv_one_line(conn)
+            resp = await recv_one_line(reader)
             if not resp:
                 print("No response from server.")
                 continue
 
             if resp.get("response") == "login" and resp.get("success"):
                 print("✅ Login successful!\n")
+                # Here we are asking once for the history; new messages are pushed by the server
+                await send_poll(writer, 0)
                 return username
             else:
                 print("❌ Incorrect username or password.\n")
@@ -203,7 +294,7 @@ def auth_flow(conn: socket.socket):
         elif choice == "2":
             # Username validation (min 3 chars)
             while True:
-                username = input("Choose a username: ").strip()
+                username = (await ainput("Choose a username: ")).strip()
                 if len(username) < 3:
                     print("❌ Username must be at least 3 characters long.")
                     continue
@@ -211,19 +302,19 @@ def auth_flow(conn: socket.socket):
 
             # Password validation (min 8 chars)
             while True:
-                password = input("Choose a password: ").strip()
+                password = (await ainput("Choose a password: ")).strip()
                 if len(password) < 8:
                     print("❌ Password must be at least 8 characters long.")
                     continue
                 break
 
-            send_json(conn, {
+            await send_json(writer, {
                 "action": "register",
                 "username": username,
                 "password": password
             })
 
-            resp = recv_one_line(conn)
+            resp = await recv_one_line(reader)
             if not resp:
                 print("No response from server.")
                 continue
@@ -237,56 +328,73 @@ def auth_flow(conn: socket.socket):
             # Here we are going back to the menu
 
 
-# Here we are in  the main function of the client
-def main():
-    
+# Here we are reading the keyboard and sending chat messages
+async def chat_loop(writer: asyncio.StreamWriter):
     """
-    Here we are in the entry point for the chat client.
-
-   
+    Here we are sending every non-empty line the user types as a chat message.
     """
-    
-    global stop_event, current_username
+    while True:
+        msg = await ainput("> ")
+        if not msg.strip():
+            continue
 
-    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    conn.connect((HOST, PORT))
-    print(f"Connected to chat server at {HOST}:{PORT}")
+        await send_chat(writer, msg)
 
-    # Here we are handling the login and registration flow
-    username = auth_flow(conn) 
-    current_username = username
 
-    # Here we are starting the receiver and poll threads
-    recv_thread = threading.Thread(target=receiver_loop, args=(conn,), daemon=True)
-    recv_thread.start()
-    poll_thread = threading.Thread(target=poll_loop, args=(conn,), daemon=True)     
-    poll_thread.start()
+# Here we are running the whole session on one event loop
+async def run():
+    """
+    Here we are connecting, logging in and then running the receiver and the keyboard side by side.
 
-    print("=== Welcome to the Chat Room ===")
-    print("Type your messages and press Enter.")
-    print("Press Ctrl+C to exit.\n")
+    The session ends when either side finishes: the server closing the connection or stdin closing.
+    """
+    state = ClientState()
+
+    reader, writer = await asyncio.open_connection(HOST, PORT, limit=STREAM_LIMIT)
+    # Here we are sending each small JSON line immediately and detecting dead connections
+    sock = writer.get_extra_info("socket")
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    print(f"Connected to chat server at {HOST}:{PORT}")
 
     try:
-        while True:
-            msg = input("> ")
-            if not msg.strip():
-                continue
+        # Here we are handling the login and registration flow
+        state.username = await auth_flow(reader, writer)
+
+        print("=== Welcome to the Chat Room ===")
+        print("Type your messages and press Enter.")
+        print("Press Ctrl+C to exit.\n")
+
+        # Here we are starting the receiver task next to the keyboard task
+        tasks = {
+            asyncio.create_task(receiver_loop(reader, writer, state)),
+            asyncio.create_task(chat_loop(writer)),
+        }
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+    finally:
+        writer.close()
 
-            send_json(conn, {
-                "action": "send_message",
-                "content": msg
-            })
 
-    except KeyboardInterrupt:
-        print("\nExiting chat...")
+# Here we are in  the main function of the client
+def main():
+    
+    """
+    Here we are in the entry point for the chat client.
 
-    finally:
-        stop_event.set()
-        try:
-            conn.close()
-        except OSError:
-            pass
-        sys.exit(0)
+   
+    """
+
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, EOFError):
+        print("\nExiting chat...")
+    sys.exit(0)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,32 @@
 """
 Authentication helpers for hashing and verifying passwords.
 """
-from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+from werkzeug.security import check_password_hash
+
+
+# Here we are creating one Argon2id hasher that is shared by every login and registration
+_hasher = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1)
 
 
 def hash_password(plain_password: str) -> str:
     """
-    Here we are returning a secure hash of the given plaintext password.
+    Here we are returning a secure Argon2id hash of the given plaintext password.
     """
-    return generate_password_hash(plain_password)
+    return _hasher.hash(plain_password)
 
 
 def verify_password(plain_password: str, hashed: str) -> bool:
     """
     Here we are checking whether the plaintext password matches the stored hash.
+
+    Hashes created before the switch to Argon2 are still checked with werkzeug.
     """
-    return check_password_hash(hashed, plain_password)
+    if not hashed.startswith("$argon2"):
+        return check_password_hash(hashed, plain_password)
+
+    try:
+        return _hasher.verify(hashed, plain_password)
+    except (VerificationError, InvalidHash):
+        return False
@@ -1,14 +1,54 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from datetime import datetime, timezone
 from typing import cast
+from sqlalchemy import bindparam, func, insert, select
+from sqlalchemy.orm import scoped_session
 from models import SessionLocal, User, Message
 from auth import hash_password, verify_password
+from runtime import json_dumps
+
+
+# Here we are keeping one session per worker thread instead of opening a new one per call
+Session = scoped_session(SessionLocal)
+
+# Here we are caching the encoded JSON of the most recent messages so polls do not re-encode them
+RECENT_CACHE_SIZE = 4096
+_recent = deque(maxlen=RECENT_CACHE_SIZE)   # (message id, encoded JSON bytes), oldest first
+_recent_lock = threading.Lock()
+
+# Here we are queueing new messages for the single writer thread, which commits them in batches
+WRITE_BATCH_SIZE = 128
+_write_q = queue.Queue()    # (sender, content, timestamp, Future)
+_writer_thread = None
+_cache_enabled = True    # False when other processes also write, since the caches would miss their messages
+
+# Here we are inserting a whole batch with one INSERT ... RETURNING id instead of going through the ORM
+_INSERT_STMT = insert(Message.__table__).returning(Message.__table__.c.id, sort_by_parameter_order=True)
+
+# Here we are tracking the highest stored message ID so empty polls can skip the database
+_max_msg_id = None    # None until start_writer() has read it from the database
+
+# Here we are building the poll query once; SQLAlchemy reuses its compiled form on every call
+_GET_AFTER_STMT = (
+    select(Message.id, Message.sender, Message.text, Message.timestamp)
+    .where(Message.id > bindparam("last_id"))
+    .order_by(Message.id)
+    .limit(bindparam("limit"))
+)
+
+# Here we are filling in the poll entry directly; only the string fields need JSON escaping
+MESSAGE_JSON = b'{"id":%d,"sender":%b,"content":%b,"timestamp":%b}'
 
 
 def get_db():
     """
-    Here we are creating and returning a new SQLAlchemy database session.
+    Here we are returning the SQLAlchemy session bound to the current thread.
     """
-    return SessionLocal()
-    
+    return Session()
+
 
 def create_user(username, plain_password):
     """
@@ -18,18 +58,18 @@ def create_user(username, plain_password):
     """
     db = get_db()
 
-    existing = db.query(User).filter_by(username=username).first()
-    if existing:
-        db.close()
-        return False, "Username already exists"
-
+    # Here we are hashing before the transaction opens, so the slow Argon2 work never holds
+    # a SQLite read lock that later has to be upgraded to a write
     hashed = hash_password(plain_password)
 
-    new_user = User(username=username, password_hash=hashed)
+    with db.begin():
+        existing = db.query(User).filter_by(username=username).first()
+        if existing:
+            return False, "Username already exists"
 
-    db.add(new_user)
-    db.commit()
-    db.close()
+        new_user = User(username=username, password_hash=hashed)
+
+        db.add(new_user)
 
     return True, "User created successfully"
 
@@ -47,21 +87,43 @@ def verify_user(username, plain_password):
     """
     db = get_db()
 
-    user = db.query(User).filter_by(username=username).first()
-    if not user:
-        db.close()
-        return False
+    with db.begin():
+        user = db.query(User).filter_by(username=username).first()
+        if not user:
+            return False
+
+        password_hash = cast(str, user.password_hash)
+
+    return verify_password(plain_password, password_hash)
 
-    result = verify_password(plain_password, cast(str, user.password_hash))
-    db.close()
 
-    return result
+def submit_message(sender_username, content):
+    """
+    Here we are stamping a new chat message and handing it to the writer thread.
+
+    Args:
+        sender_username (str): Username of the sender.
+        content (str): The message text.
+
+    Returns:
+        Future: Resolves to the (ID, timestamp string) tuple once the message's batch is committed.
+    """
+    # Here we are stamping naive UTC, since SQLite stores it that way; broadcasts, cached
+    # poll entries and rows read back from the database then all format it the same
+    stamp = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    fut = Future()
+    _write_q.put((sender_username, content, stamp, fut))
+    return fut
 
 
 def save_message(sender_username, content):
     """
     Here we are saving a new chat message to the database.
 
+    This call waits until the message's batch is committed; async callers can await
+    submit_message() instead of tying up a thread.
+
     Args:
         sender_username (str): Username of the sender.
         content (str): The message text.
@@ -69,38 +131,186 @@ def save_message(sender_username, content):
     Returns:
         tuple[int, str]: The auto-incremented ID and the ISO timestamp string.
     """
+    return submit_message(sender_username, content).result()
+
+
+def start_writer(use_cache=True):
+    """
+    Here we are starting the background thread that commits queued messages.
+
+    Args:
+        use_cache (bool): Whether this process is the only writer, so the in-memory message
+            cache and the ID watermark can be trusted. Pass False when several server
+            processes share the database.
+    """
+    global _writer_thread, _max_msg_id, _cache_enabled
+
+    if _writer_thread is None:
+        _cache_enabled = use_cache
+        if use_cache:
+            db = get_db()
+            with db.begin():
+                _max_msg_id = db.execute(select(func.max(Message.id))).scalar() or 0
+
+        _writer_thread = threading.Thread(target=_writer_loop, name="db-writer", daemon=True)
+        _writer_thread.start()
+
+
+def _writer_loop():
+    """
+    Here we are draining the write queue and committing up to WRITE_BATCH_SIZE messages at once.
+
+    Messages whose future was cancelled before they were dequeued are dropped, and settling
+    a future never raises, so no caller can stop the only writer thread.
+    """
+    while True:
+        batch = []
+        item = _write_q.get()
+        while True:
+            if item[-1].set_running_or_notify_cancel():
+                batch.append(item)
+            if len(batch) >= WRITE_BATCH_SIZE:
+                break
+            try:
+                item = _write_q.get_nowait()
+            except queue.Empty:
+                break
+
+        if not batch:
+            continue
+
+        try:
+            results = _insert_batch(batch)
+        except Exception:
+            # Here we are retrying the rows one by one so a single bad row fails only its own sender
+            for item in batch:
+                try:
+                    (result,) = _insert_batch([item])
+                except Exception as exc:
+                    _settle(item[-1], exc=exc)
+                else:
+                    _settle(item[-1], result)
+            continue
+
+        for (*_, fut), result in zip(batch, results):
+            _settle(fut, result)
+
+
+def _settle(fut, result=None, exc=None):
+    """
+    Here we are resolving a writer future, ignoring one that was already settled.
+    """
+    try:
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _insert_batch(batch):
+    """
+    Here we are inserting a batch of messages in one transaction.
+
+    Returns:
+        list[tuple[int, str]]: The ID and timestamp of each message, in batch order.
+    """
     db = get_db()
 
-    msg = Message(sender=sender_username, receiver="ALL", text=content)
-    db.add(msg)
-    db.commit()
-    # Ensure autoincremented ID is loaded before closing session
-    db.refresh(msg)
-    mid = msg.id
-    ts = str(msg.timestamp)
-    db.close()
-    return mid, ts
+    with db.begin():
+        ids = db.execute(_INSERT_STMT, [
+            {"sender": sender, "receiver": "ALL", "text": content, "timestamp": ts}
+            for sender, content, ts, _ in batch
+        ]).scalars().all()
+
+    # The timestamps were set by save_message, so only the IDs had to come back from the database
+    results = [(mid, str(ts)) for mid, (_, _, ts, _) in zip(ids, batch)]
+
+    if not _cache_enabled:
+        return results
+
+    # Only this thread writes, so appending after the commit keeps the cache in ID order
+    global _max_msg_id
+    with _recent_lock:
+        for (sender, content, _, _), (mid, ts) in zip(batch, results):
+            _recent.append((mid, encode_message(mid, sender, content, ts)))
+        _max_msg_id = max(_max_msg_id or 0, ids[-1])
+
+    return results
+
+
+def get_max_message_id():
+    """
+    Here we are returning the highest stored message ID, or None before start_writer() has run.
+
+    The value only grows, so callers can use it as an epoch for caches of poll results.
+    """
+    return _max_msg_id
 
 
-def get_messages_after(last_id: int):
+def get_messages_after(last_id: int, limit: int):
     """
-    Here we are retrieving all messages with an ID greater than the given value.
+    Here we are retrieving up to limit messages with an ID greater than the given value.
+
+    The transaction ends before this returns; callers page through long histories with limit.
 
     Args:
         last_id (int): The last message ID the client has received.
+        limit (int): The most rows to return.
 
     Returns:
-        list[Message]: Here we are returning all newer message objects sorted by ID.
+        list[Row]: Here we are returning (id, sender, text, timestamp) tuples sorted by ID.
     """
+    # Here we are answering the common idle poll without touching the database
+    if _max_msg_id is not None and last_id >= _max_msg_id:
+        return []
+
     db = get_db()
 
-    msgs = (
-        db.query(Message)
-        .filter(Message.id > last_id)
-        .order_by(Message.id.asc())
-        .all()
-    )
-    db.close()
+    # Selecting plain columns skips building ORM objects; the primary key already keeps rows in ID order
+    with db.begin():
+        msgs = db.execute(_GET_AFTER_STMT, {"last_id": last_id, "limit": limit}).all()
 
     return msgs
 
+
+def encode_message(mid, sender, content, ts):
+    """
+    Here we are encoding one message the way it appears inside a poll response.
+
+    The row values are passed positionally and filled into MESSAGE_JSON, so no dict is built per row.
+
+    Returns:
+        bytes: The JSON object for the message.
+    """
+    return MESSAGE_JSON % (mid, json_dumps(sender), json_dumps(content), json_dumps(ts))
+
+
+def get_message_payloads_after(last_id: int, limit: int):
+    """
+    Here we are returning the encoded JSON of up to limit messages with an ID greater than last_id.
+
+    Recent messages come from the in-memory cache; older ranges fall back to the database.
+
+    Args:
+        last_id (int): The last message ID the client has received.
+        limit (int): The most messages to return, oldest first.
+
+    Returns:
+        list[bytes]: Encoded messages sorted by ID.
+    """
+    with _recent_lock:
+        if _recent and last_id >= _recent[0][0] - 1:
+            payloads = []
+            for mid, payload in reversed(_recent):
+                if mid <= last_id:
+                    break
+                payloads.append(payload)
+            payloads.reverse()
+            return payloads[:limit]
+
+    return [
+        encode_message(mid, sender, text, str(ts))
+        for mid, sender, text, ts in get_messages_after(last_id, limit)
+    ]
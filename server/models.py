@@ -6,18 +6,38 @@ This module defines:
 - SQLAlchemy ORM models for User and Message.
 - The init_db() function that creates tables at startup.
 """
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime, timezone
 from pathlib import Path
+import os
 
 
 # Here we are setting up the database
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 DB_PATH = (PROJECT_ROOT / "chat.db").resolve()
-engine = create_engine(f"sqlite:///{DB_PATH.as_posix()}", echo=True)
+# Here we are logging every SQL statement only when SQL_DEBUG is set
+engine = create_engine(f"sqlite:///{DB_PATH.as_posix()}", echo=bool(os.getenv("SQL_DEBUG")))
+
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Here we are switching every new SQLite connection to WAL mode.
+
+    WAL lets readers run while a message is being written, and synchronous=NORMAL
+    only syncs at checkpoints instead of on every commit.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
 Base = declarative_base()
-SessionLocal = sessionmaker(bind=engine)
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
 
 class User(Base):
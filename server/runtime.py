@@ -0,0 +1,58 @@
+"""
+Runtime selection for the chat server.
+
+This module picks the fastest JSON backend and event loop for the running interpreter:
+- On CPython, orjson is used when it is installed.
+- On PyPy, the standard library json module is used; orjson has no PyPy build
+  and PyPy's JIT already makes json fast.
+- On CPython, uvloop (libuv) replaces the default asyncio event loop when it is installed.
+"""
+import asyncio
+import json
+import platform
+
+
+IS_PYPY = platform.python_implementation() == "PyPy"
+
+
+def _stdlib_dumps(data) -> bytes:
+    """
+    Here we are encoding with the standard library and returning UTF-8 bytes like orjson does.
+    """
+    return json.dumps(data).encode()
+
+
+if IS_PYPY:
+    json_dumps = _stdlib_dumps
+    json_loads = json.loads
+else:
+    try:
+        import orjson
+
+        json_dumps = orjson.dumps
+        json_loads = orjson.loads
+    except ImportError:
+        json_dumps = _stdlib_dumps
+        json_loads = json.loads
+
+
+# Here we are running the server on uvloop when it is available; otherwise the stock asyncio loop
+if IS_PYPY:
+    uvloop = None
+else:
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+
+
+def run(main):
+    """
+    Here we are running a coroutine to completion on the selected event loop.
+
+    Args:
+        main (coroutine): The coroutine to run, like asyncio.run().
+    """
+    if uvloop is None:
+        return asyncio.run(main)
+    return uvloop.run(main)
@@ -2,141 +2,506 @@
 TCP chat server for the multi-user chatroom application.
 
 This server:
-- Accepts client connections over TCP.
+- Accepts client connections over TCP on a single asyncio event loop.
 - Handles login and registration.
 - Stores messages in the database.
-- Broadcasts new messages to all connected users.
-- Supports polling for message history.
+- Pushes new messages to all connected users through per-connection outboxes.
+- Supports polling for message history when a client (re)connects.
 """
 
+import asyncio
+import os
 import socket
 import threading
-import json
-from db import create_user, verify_user, save_message, get_messages_after
-from models import init_db
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+from db import (
+    create_user, verify_user, submit_message, get_message_payloads_after, get_max_message_id, start_writer
+)
+from models import engine, init_db
+from runtime import json_dumps, json_loads, run
 
 
 HOST = "0.0.0.0"
 PORT = 5000
+MAX_FRAME_SIZE = 64 * 1024    # Here we are capping the size of one JSON line from a client
+WORKERS = int(os.getenv("CHAT_SERVER_WORKERS", "1"))    # Here we are choosing how many processes accept clients
 
 
-clients = {}    # Here we are storing the clients
+OUTBOX_SIZE = 1024            # Here we are limiting how many frames may wait for one slow client
+CLOSE_TIMEOUT = 5             # Here we are limiting how long a closing client may take to flush
+SEND_BUFFER_SIZE = 256 * 1024 # Here we are giving each socket room for a large history reply
+LISTEN_BACKLOG = 1024         # Here we are letting a burst of new connections wait to be accepted
+POLL_PAGE_SIZE = 500          # Here we are capping how many messages one poll reply carries
+POLL_PAGE_BYTES = 1024 * 1024 # Here we are capping roughly how large one poll reply grows
+POLL_CACHE_BYTES = 16 * 1024 * 1024   # Here we are capping the memory held by cached poll replies
+DB_THREADS = 4                # Here we are bounding the threads that run database and password work
 
 
-def send_json(conn, data):
+@dataclass
+class Connection:
     """
-    Here we are sending a Python dictionary as a JSON message terminated by a newline.
+    Here we are keeping the state of one client connection.
+
+    Every outgoing frame goes through the outbox, so a broadcast only enqueues bytes and
+    never waits on a slow client. The connection's writer task sends them in order.
+    """
+    writer: asyncio.StreamWriter
+    username: Optional[str] = None
+    outbox: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(OUTBOX_SIZE))
+
+    def send(self, frame):
+        """
+        Here we are queueing one newline-terminated frame for this client.
+
+        A client whose outbox is full has stopped reading, so its connection is aborted
+        at once; a graceful close would wait for the same peer to read what is buffered.
+        """
+        if self.writer.is_closing():
+            return
+        try:
+            self.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            self.writer.transport.abort()
+
+
+# Here we are storing the logged-in clients in CLIENT_SHARDS immutable tuples, picked by username hash.
+# Login and logout rebuild only the tuple of that username's shard and put it back in the list,
+# so a reconnect storm costs a fraction of the client count per login, and a broadcast
+# iterates the shards without copying them or locking.
+CLIENT_SHARDS = 64
+_client_shards = [()] * CLIENT_SHARDS
+
+
+def _shard_index(username):
+    """
+    Here we are mapping a username to the shard that holds its connection.
+    """
+    return hash(username) & (CLIENT_SHARDS - 1)
+
+
+def add_client(conn):
+    """
+    Here we are publishing a new shard tuple that includes this connection under its username.
+    """
+    i = _shard_index(conn.username)
+    _client_shards[i] = tuple(
+        c for c in _client_shards[i] if c.username != conn.username
+    ) + (conn,)
+
+
+def remove_client(conn):
+    """
+    Here we are publishing a new shard tuple without this connection.
+
+    Only this connection is removed, so a newer login under the same name stays connected.
+    """
+    i = _shard_index(conn.username)
+    _client_shards[i] = tuple(c for c in _client_shards[i] if c is not conn)
+
+
+def error_frame(info):
+    """
+    Here we are encoding an error reply as a JSON line.
+
+    Args:
+        info (str): The error description shown to the client.
+
+    Returns:
+        bytes: The newline-terminated error frame.
+    """
+    return json_dumps({"response": "error", "info": info}) + b"\n"
+
+
+# Here we are building every reply shape once; per call only the changing fields are encoded
+LOGIN_OK_FRAME = json_dumps({"response": "login", "success": True}) + b"\n"
+LOGIN_FAILED_FRAME = json_dumps({"response": "login", "success": False}) + b"\n"
+INVALID_JSON_FRAME = error_frame("Invalid JSON")
+TOO_LONG_FRAME = error_frame("Message too long")
+UNSUPPORTED_FRAME = error_frame("Unsupported action")
+NOT_LOGGED_IN_FRAME = error_frame("Not logged in")
+INVALID_LAST_ID_FRAME = error_frame("Invalid last_id")
+REGISTER_FRAME = b'{"response":"register","success":%b,"info":%b}\n'
+NEW_MESSAGE_FRAME = b'{"response":"new_message","id":%d,"from":%b,"content":%b,"timestamp":%b}\n'
+
+
+async def write_outbox(conn):
+    """
+    Here we are sending the queued frames of one connection until it receives None
+    or the connection is closed.
+
+    Every frame already waiting in the outbox goes out in one writelines() call and one drain,
+    so a burst of broadcasts costs one send on the socket instead of one per frame.
+    """
+    try:
+        while True:
+            frames = [await conn.outbox.get()]
+            while not conn.outbox.empty() and frames[-1] is not None:
+                frames.append(conn.outbox.get_nowait())
+
+            # Here we are stopping as soon as the connection was closed or aborted under us
+            if conn.writer.is_closing():
+                break
+
+            closing = frames[-1] is None
+            if closing:
+                frames.pop()
+            if frames:
+                conn.writer.writelines(frames)
+                await conn.writer.drain()
+            if closing:
+                break
+    except ConnectionError:
+        conn.writer.close()
+
+
+# Here we are caching poll pages of the current epoch, least recently used first, within POLL_CACHE_BYTES.
+# The epoch is the highest stored message ID, so a new message empties the cache, and
+# clients polling with the same last_id in between share one database lookup.
+_poll_cache = OrderedDict()    # last_id -> frame
+_poll_cache_bytes = 0
+_poll_epoch = None
+_poll_lock = threading.Lock()    # poll_frame runs on several executor threads
+
+
+def _poll_frame(last_id):
+    """
+    Here we are building one page of the poll response for last_id.
+
+    A page holds at most POLL_PAGE_SIZE messages and stops growing past POLL_PAGE_BYTES,
+    so no reply outgrows the client's line limit. "more" tells the client to poll again
+    from the last ID it received.
 
     Args:
-        conn (socket.socket): The connection to send through.
-        data (dict): The JSON-serializable data to send.
+        last_id (int): The last message ID the client has received.
+
+    Returns:
+        bytearray: The newline-terminated poll response; nobody may modify it once cached.
+    """
+    # Here we are appending each already-encoded message of the page to one buffer
+    frame = bytearray(b'{"response":"poll","messages":[')
+    separator = b""
+    count = 0
+    more = False
+    for payload in get_message_payloads_after(last_id, POLL_PAGE_SIZE + 1):
+        if count == POLL_PAGE_SIZE or len(frame) >= POLL_PAGE_BYTES:
+            more = True
+            break
+        frame += separator
+        frame += payload
+        separator = b","
+        count += 1
+    frame += b'],"more":true}\n' if more else b'],"more":false}\n'
+
+    # Here we are returning the buffer itself; copying it to bytes would double the peak size
+    return frame
+
+
+def poll_frame(last_id):
+    """
+    Here we are returning the poll response for last_id, from the cache when the epoch is known.
+
+    Clients choose last_id freely, so the cache is bounded by the total size of its frames
+    rather than by entry count; the least recently used pages are dropped first.
+    """
+    global _poll_epoch, _poll_cache_bytes
+
+    epoch = get_max_message_id()
+    if epoch is None:
+        return _poll_frame(last_id)
+
+    with _poll_lock:
+        # Here we are dropping frames from older epochs so large history replies do not pile up
+        if epoch != _poll_epoch:
+            _poll_cache.clear()
+            _poll_cache_bytes = 0
+            _poll_epoch = epoch
+
+        frame = _poll_cache.get(last_id)
+        if frame is not None:
+            _poll_cache.move_to_end(last_id)
+            return frame
+
+    frame = _poll_frame(last_id)
+
+    with _poll_lock:
+        if epoch == _poll_epoch and last_id not in _poll_cache:
+            _poll_cache[last_id] = frame
+            _poll_cache_bytes += len(frame)
+            while _poll_cache_bytes > POLL_CACHE_BYTES:
+                _, old = _poll_cache.popitem(last=False)
+                _poll_cache_bytes -= len(old)
+
+    return frame
+
+
+# Here we are keeping one Connection per other worker process (empty with one worker).
+# Peer links reuse the bounded outbox, so a stalled worker is cut off instead of
+# making this one buffer broadcasts without limit.
+_peers = ()
+
+# Here we are holding references to long-lived tasks so they are not garbage collected
+_background_tasks = set()
+
+
+def spawn(coro):
+    """
+    Here we are starting a background task and keeping it alive until it finishes.
     """
-    conn.sendall((json.dumps(data) + "\n").encode())
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 
-def handle_client(conn, addr):
+def deliver(payload):
+    """
+    Here we are queueing one already-encoded frame for every client logged in to this process.
+
+    Args:
+        payload (bytes): The newline-terminated JSON frame.
+    """
+    for shard in _client_shards:
+        for conn in shard:
+            conn.send(payload)
+
+
+def broadcast(payload):
+    """
+    Here we are sending one already-encoded frame to every logged-in client of every worker.
+
+    Args:
+        payload (bytes): The newline-terminated JSON frame.
+    """
+    deliver(payload)
+    for peer in _peers:
+        peer.send(payload)
+
+
+async def read_peer(reader):
+    """
+    Here we are delivering the frames another worker broadcast to the clients of this worker.
+    """
+    async for line in reader:
+        deliver(line)
+
+
+# Here we are handling the registration flow
+async def _do_register(conn, msg):
+    user = msg["username"]
+    pasw = msg["password"]
+
+    loop = asyncio.get_running_loop()
+    ok, info = await loop.run_in_executor(None, create_user, user, pasw)
+    conn.send(REGISTER_FRAME % (b"true" if ok else b"false", json_dumps(info)))
+
+
+# Here we are handling the login flow
+async def _do_login(conn, msg):
+    user = msg["username"]
+    pasw = msg["password"]
+
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, verify_user, user, pasw):
+        if conn.username:
+            remove_client(conn)
+        conn.username = user
+        add_client(conn)
+        conn.send(LOGIN_OK_FRAME)
+    else:
+        conn.send(LOGIN_FAILED_FRAME)
+
+
+# Here we are handling the sending of messages
+async def _do_send(conn, msg):
+    if conn.username is None:
+        conn.send(NOT_LOGGED_IN_FRAME)
+        return
+
+    content = msg["content"]
+
+    # Here we are awaiting the writer thread's future directly instead of blocking a pool thread on it
+    msg_id, ts = await asyncio.wrap_future(submit_message(conn.username, content))
+
+    # Here we are encoding the broadcast once and queueing the same bytes for every client
+    broadcast(NEW_MESSAGE_FRAME % (msg_id, json_dumps(conn.username), json_dumps(content), json_dumps(ts)))
+
+
+# Here we are answering a catch-up request; live messages arrive through broadcast
+async def _do_poll(conn, msg):
+    last_id = msg.get("last_id", 0)
+
+    # Here we are accepting only integer IDs, since the value keys the poll cache and the SQL query
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        conn.send(INVALID_LAST_ID_FRAME)
+        return
+    last_id = max(last_id, 0)
+
+    loop = asyncio.get_running_loop()
+    conn.send(await loop.run_in_executor(None, poll_frame, last_id))
+
+
+# Here we are handling unknown actions
+async def _do_unknown(conn, msg):
+    conn.send(UNSUPPORTED_FRAME)
+
+
+HANDLERS = {
+    "register": _do_register,
+    "login": _do_login,
+    "send_message": _do_send,
+    "poll": _do_poll,
+}
+
+
+async def handle_client(reader, writer):
     """
     Here we are handling communication with a single connected client.
 
- 
+    Database calls run in the loop's thread pool so they never block other clients.
     """
+    addr = writer.get_extra_info("peername")
     print(f"[NEW CONNECTION] {addr} connected.")
 
-    username = None
+    # Here we are sending each small JSON line immediately, detecting dead connections
+    # and sizing the kernel send buffer for catch-up polls
+    sock = writer.get_extra_info("socket")
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+
+    conn = Connection(writer)
+    sender = asyncio.create_task(write_outbox(conn))
 
     try:
         while True:
-            data = conn.recv(1024).decode()
-
-            if not data:
+            # Here we are reading exactly one newline-terminated frame, however it was split on the wire
+            try:
+                line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError:
                 break
+            except asyncio.LimitOverrunError:
+                conn.send(TOO_LONG_FRAME)
+                break
+
+            if not line.strip():
+                continue
 
-            for line in data.strip().split("\n"):
-                msg = json.loads(line)
-
-                action = msg.get("action")
-
-                # Here we are handling the registration flow
-                if action == "register":
-                    user = msg["username"]
-                    pasw = msg["password"]
-
-                    ok, info = create_user(user, pasw)
-                    send_json(conn, {"response": "register", "success": ok, "info": info})
-
-                # Here we are handling the login flow
-                elif action == "login":
-                    user = msg["username"]
-                    pasw = msg["password"]
-
-                    if verify_user(user, pasw):
-                        username = user
-                        clients[username] = conn
-                        send_json(conn, {"response": "login", "success": True})
-                    else:
-                        send_json(conn, {"response": "login", "success": False})
-
-                # Here we are handling the sending of messages
-                elif action == "send_message":
-                    content = msg["content"]
-
-                    msg_id, ts = save_message(username, content)
-
-                    # Here we are broadcasting the message to all clients
-                    for user_conn in clients.values():
-                        send_json(user_conn, {
-                            "response": "new_message",
-                            "id": msg_id,
-                            "from": username,
-                            "content": content,
-                            "timestamp": ts
-                        })
-
-                # Here we are polling the server for new messages
-                elif action == "poll":
-                    last_id = msg.get("last_id", 0)
-                    messages = get_messages_after(last_id)
-
-                    response = []
-                    for m in messages:
-                        response.append({
-                            "id": m.id,
-                            "sender": m.sender,
-                            "content": m.text,
-                            "timestamp": str(m.timestamp)
-                        })
-
-                    send_json(conn, {"response": "poll", "messages": response})
-
-                # Here we are handling unknown actions
-                else:
-                    send_json(conn, {"response": "error", "info": "Unsupported action"})
+            try:
+                msg = json_loads(line)
+            except ValueError:
+                conn.send(INVALID_JSON_FRAME)
+                continue
+
+            # Here we are dispatching on the action with one dictionary lookup
+            handler = HANDLERS.get(msg.get("action"), _do_unknown)
+            await handler(conn, msg)
+    except ConnectionError:
+        pass
     finally:
-        if username and username in clients:
-            del clients[username]
-        conn.close()
+        if conn.username:
+            remove_client(conn)
+        # Here we are letting the writer task flush what is already queued before closing.
+        # An aborted or full connection has nothing worth flushing, so its task is cancelled.
+        try:
+            if writer.is_closing():
+                raise asyncio.QueueFull
+            conn.outbox.put_nowait(None)
+        except asyncio.QueueFull:
+            writer.transport.abort()
+            sender.cancel()
+        done, _ = await asyncio.wait({sender}, timeout=CLOSE_TIMEOUT)
+        if not done:
+            sender.cancel()
+        writer.close()
         print(f"[DISCONNECTED] {addr} disconnected.")
         
 
-def start_server():
+async def start_server(peer_socks=()):
     """
-    Here we are starting the TCP server.
-   
+    Here we are starting the TCP server on the asyncio event loop.
+
+    Args:
+        peer_socks (tuple[socket.socket]): One Unix socket to each other worker process.
+            When there are peers, the listening socket uses SO_REUSEPORT so the kernel
+            spreads new connections across the workers.
     """
-    print("[STARTING SERVER] Chat Server running...")
-    init_db()
+    global _peers
+
+    # Here we are trusting the in-memory message caches only when this process is the sole writer
+    start_writer(use_cache=not peer_socks)
+
+    # Here we are running blocking handler work on a fixed pool, whatever the number of clients.
+    # Each pool thread keeps its own SQLAlchemy session through db.Session, and at most
+    # DB_THREADS argon2 hashes (64 MiB each) run at once.
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+    )
+
+    peers = []
+    for sock in peer_socks:
+        reader, writer = await asyncio.open_unix_connection(sock=sock, limit=4 * MAX_FRAME_SIZE)
+        peer = Connection(writer)
+        spawn(read_peer(reader))
+        spawn(write_outbox(peer))
+        peers.append(peer)
+    _peers = tuple(peers)
+
+    server = await asyncio.start_server(
+        handle_client, HOST, PORT, limit=MAX_FRAME_SIZE, backlog=LISTEN_BACKLOG,
+        reuse_port=True if peer_socks else None
+    )
+
+    print(f"[LISTENING] Worker {os.getpid()} running on {HOST}:{PORT}")
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen()
+    async with server:
+        await server.serve_forever()
 
-    print(f"[LISTENING] Server running on {HOST}:{PORT}")
 
-    while True:
-        conn, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr))
-        thread.start()
+def main():
+    """
+    Here we are creating the database and starting WORKERS server processes.
+
+    Workers are forked before any event loop exists and are connected pairwise with
+    Unix socket pairs, so a broadcast in one worker reaches clients of all the others.
+    """
+    print("[STARTING SERVER] Chat Server running...")
+    init_db()
+
+    if WORKERS <= 1:
+        run(start_server())
+        return
+
+    pairs = {
+        (i, j): socket.socketpair()
+        for i in range(WORKERS) for j in range(i + 1, WORKERS)
+    }
+
+    index = 0
+    for worker in range(1, WORKERS):
+        if os.fork() == 0:
+            index = worker
+            # Here we are dropping SQLite connections inherited from the parent
+            engine.dispose(close=False)
+            break
+
+    # Here we are keeping only this worker's end of each pair it belongs to
+    peer_socks = []
+    for (i, j), (a, b) in pairs.items():
+        if index == i:
+            peer_socks.append(a)
+            b.close()
+        elif index == j:
+            peer_socks.append(b)
+            a.close()
+        else:
+            a.close()
+            b.close()
+
+    run(start_server(tuple(peer_socks)))
 
 
 if __name__ == "__main__":
-    start_server()
+    main()